@@ -1,5 +1,7 @@
+from bisect import bisect_left
+from collections import defaultdict
 from pympi.Elan import Eaf
-from typing import Dict, List, Union, Type
+from typing import Dict, List, Optional, Tuple, Type
 
 """
 This script builds an Elan file using tiers from two input files.
@@ -18,26 +20,6 @@ BTW, This script won't run in PyCharm due to this custom pip install. Gotta do i
 """
 
 
-def get_info(eaf: Type[Eaf]):
-    """
-    Just a handy helper to show info about a tier
-
-    :param eaf: an Elan object
-    :return:
-    """
-    type_names = eaf.get_linguistic_type_names()
-    print("type_names", type_names)
-
-    for type_name in eaf.get_linguistic_type_names():
-        phrases_type_params = eaf.get_parameters_for_linguistic_type(type_name)
-        print("type:", type_name, phrases_type_params)
-
-    tier_names = eaf.get_tier_names()
-    for tier_name in tier_names:
-        params = eaf.get_parameters_for_tier(tier_name)
-        print("tier:", tier_name, params)
-
-
 def copy_media(eaf_1: Type[Eaf], eaf_3: Type[Eaf]):
     """
     Copy the media file info from file 1 into the new file
@@ -48,18 +30,104 @@ def copy_media(eaf_1: Type[Eaf], eaf_3: Type[Eaf]):
     """
     # Get all the media for the first file
     media = eaf_1.media_descriptors
-    # Get params for first media item, unpack into vars
-    media_params = sorted(media[0].items())
-    file_path, mimetype, relpath = [v[1] for v in media_params]
+    # Get params for first media item. Relative path is optional in EAF
+    media_params = media[0]
+    file_path = media_params['MEDIA_URL']
+    mimetype = media_params['MIME_TYPE']
+    relpath = media_params.get('RELATIVE_MEDIA_URL')
     eaf_3.add_linked_file(file_path, mimetype=mimetype, relpath=relpath)
     return eaf_3
 
 
+def _reserve_annotation_ids(target_eaf: Type[Eaf], target_tier_name: str, count: int) -> List[str]:
+    """
+    Reserve a block of annotation ids on a tier in one go, rather than generating them one annotation at a time
+
+    :param target_eaf: The Eaf object the annotations will be written to
+    :param target_tier_name: The tier the annotations belong to
+    :param count: How many ids to reserve
+    :return: List of the new annotation ids
+    """
+    base = target_eaf.maxaid + 1
+    target_eaf.maxaid += count
+    aids = [f"a{base + i}" for i in range(count)]
+    # pympi keeps an index of which tier each annotation is on, used to follow ref annotations up to their parents
+    target_eaf.annotations.update(dict.fromkeys(aids, target_tier_name))
+    return aids
+
+
+def _check_annotations(target_eaf: Type[Eaf], target_tier_name: str, annotations: List[tuple], aligned: bool):
+    """
+    Make the same checks add_annotation / add_ref_annotation would, before annotations are written in bulk
+
+    :param target_eaf: The Eaf object the annotations will be written to
+    :param target_tier_name: The tier the annotations will be written to
+    :param annotations: Annotations of the form (start, end, value, ...)
+    :param aligned: True if they will be written as aligned annotations, False for ref annotations
+    :raises ValueError: If the tier already holds the other kind of annotation, or an aligned annotation has bad times
+    """
+    if not aligned:
+        if target_eaf.tiers[target_tier_name][0]:
+            raise ValueError('This tier already contains normal annotations.')
+        return
+    if target_eaf.tiers[target_tier_name][1]:
+        raise ValueError('Tier already contains ref annotations...')
+    for start, end, *_ in annotations:
+        if not isinstance(start, int) or not isinstance(end, int):
+            raise ValueError('start and end must be an integer...')
+        if start == end:
+            raise ValueError('Annotation length is zero...')
+        if start > end:
+            raise ValueError('Annotation length is negative...')
+        if start < 0:
+            raise ValueError('Start is negative...')
+
+
+def _parent_ids(eaf: Type[Eaf], tier_name: str, times: List[int]) -> List[str]:
+    """
+    Find the annotation on a tier that each time falls within, the same way add_ref_annotation picks a parent:
+    the first annotation in tier order whose span covers the time.
+    When the spans run in time order (the usual case) this bisects instead of scanning the whole tier for every
+    new annotation. Overlapping or nested spans fall back to pympi's linear scan.
+
+    :param eaf: The Eaf object holding the parent tier
+    :param tier_name: Name of the parent tier, either aligned or ref
+    :param times: The times to find parents for
+    :return: List of parent annotation ids, one per time
+    """
+    aligned_annotations, ref_annotations = eaf.tiers[tier_name][0], eaf.tiers[tier_name][1]
+    if aligned_annotations:
+        spans = [(eaf.timeslots[start_ts], eaf.timeslots[end_ts], aid)
+                 for aid, (start_ts, end_ts, _, _) in aligned_annotations.items()]
+    else:
+        # Ref annotations take their times from the aligned annotation at the top of the hierarchy
+        spans = []
+        for aid in ref_annotations:
+            start_ts, end_ts, _, _ = eaf.get_parent_aligned_annotation(aid)
+            spans.append((eaf.timeslots[start_ts], eaf.timeslots[end_ts], aid))
+    starts = [span[0] for span in spans]
+    ends = [span[1] for span in spans]
+    in_time_order = all(previous_start <= start and previous_end <= end
+                        for previous_start, previous_end, start, end in zip(starts, ends, starts[1:], ends[1:]))
+    parent_ids = []
+    for time in times:
+        if in_time_order:
+            # The first span ending at or after time is the first one in tier order that could cover it
+            i = bisect_left(ends, time)
+            parent_id = spans[i][2] if i < len(spans) and starts[i] <= time else None
+        else:
+            parent_id = next((aid for start, end, aid in spans if start <= time <= end), None)
+        if parent_id is None:
+            raise ValueError('There is no annotation to reference to.')
+        parent_ids.append(parent_id)
+    return parent_ids
+
+
 def _tier_copy(source_eaf: Type[Eaf] = None,
                target_eaf: Type[Eaf] = None,
                source_tier_name: str = "",
                target_tier_name: str = "",
-               override_params: Dict[str, str] = {}):
+               override_params: Optional[Dict[str, str]] = None):
     """
     Straight up copy of a non-ref tier from one Eaf object to a new Eaf object
 
@@ -71,17 +139,22 @@ def _tier_copy(source_eaf: Type[Eaf] = None,
     :return:
     """
     # For tier params, use the passed in dict or read from source
-    params = override_params if override_params else source_eaf.get_parameters_for_tier(source_tier_name)
+    params = override_params or source_eaf.get_parameters_for_tier(source_tier_name)
     # Add new tier in target file
     target_eaf.add_tier(target_tier_name, ling=params["LINGUISTIC_TYPE_REF"], tier_dict=params)
     # Read annotations from source
     annotations = source_eaf.get_annotation_data_for_tier(source_tier_name)
-    # Write each annotation to target
-    for annotation in annotations:
-        target_eaf.add_annotation(id_tier=target_tier_name,
-                                  start=annotation[0],
-                                  end=annotation[1],
-                                  value=annotation[2])
+    _check_annotations(target_eaf, target_tier_name, annotations, aligned=True)
+    # Reserve a start and end timeslot for every annotation, in the same order generate_ts_id would make them
+    ts_base = target_eaf.maxts + 1
+    target_eaf.maxts += 2 * len(annotations)
+    ts_ids = [f"ts{ts_base + i}" for i in range(2 * len(annotations))]
+    target_eaf.timeslots.update(zip(ts_ids, (time for annotation in annotations for time in annotation[:2])))
+    # Write all the annotations to target in one go
+    aids = _reserve_annotation_ids(target_eaf, target_tier_name, len(annotations))
+    target_eaf.tiers[target_tier_name][0].update(
+        (aid, (start_ts, end_ts, annotation[2], None))
+        for aid, start_ts, end_ts, annotation in zip(aids, ts_ids[::2], ts_ids[1::2], annotations))
     return target_eaf
 
 
@@ -90,7 +163,7 @@ def _ref_tier_copy(source_eaf: Type[Eaf] = None,
                    source_tier_name: str = "",
                    target_tier_name: str = "",
                    target_parent_tier_name: str = "",
-                   override_params: Dict[str, str] = {}):
+                   override_params: Optional[Dict[str, str]] = None):
     """
     Copy annotations from a ref tier in one EAF to a new ref tier in another EAF
 
@@ -102,14 +175,15 @@ def _ref_tier_copy(source_eaf: Type[Eaf] = None,
     :param override_params: Use this to change tier params from what the tier has in the source file
     :return:
     """
-    params = override_params if override_params else source_eaf.get_parameters_for_tier(source_tier_name)
+    params = override_params or source_eaf.get_parameters_for_tier(source_tier_name)
     target_eaf.add_tier(target_tier_name, ling=params["LINGUISTIC_TYPE_REF"], parent=target_parent_tier_name, tier_dict=params)
     annotations = source_eaf.get_ref_annotation_data_for_tier(source_tier_name)
-    for annotation in annotations:
-        target_eaf.add_ref_annotation(id_tier=target_tier_name,
-                                      tier2=target_parent_tier_name,
-                                      time=annotation[0]+1,
-                                      value=annotation[2])
+    _check_annotations(target_eaf, target_tier_name, annotations, aligned=False)
+    parent_ids = _parent_ids(target_eaf, target_parent_tier_name, [annotation[0]+1 for annotation in annotations])
+    aids = _reserve_annotation_ids(target_eaf, target_tier_name, len(annotations))
+    target_eaf.tiers[target_tier_name][1].update(
+        (aid, (parent_id, annotation[2], None, None))
+        for aid, parent_id, annotation in zip(aids, parent_ids, annotations))
     return target_eaf
 
 
@@ -118,7 +192,7 @@ def _tier_copy_to_ref(source_eaf: Type[Eaf] = None,
                       source_tier_name: str = "",
                       target_tier_name: str = "",
                       target_parent_tier_name: str = "",
-                      override_params: Dict[str, str] = {}):
+                      override_params: Optional[Dict[str, str]] = None):
     """
     Copy a non-ref tier, but make it a ref tier in the destination
 
@@ -130,14 +204,15 @@ def _tier_copy_to_ref(source_eaf: Type[Eaf] = None,
     :param override_params: Use this to change tier params from what the tier has in the source file
     :return:
     """
-    params = override_params if override_params else source_eaf.get_parameters_for_tier(source_tier_name)
+    params = override_params or source_eaf.get_parameters_for_tier(source_tier_name)
     target_eaf.add_tier(target_tier_name, ling=params["LINGUISTIC_TYPE_REF"], parent=target_parent_tier_name, tier_dict=params)
     annotations = source_eaf.get_annotation_data_for_tier(source_tier_name)
-    for annotation in annotations:
-        target_eaf.add_ref_annotation(id_tier=target_tier_name,
-                                      tier2=target_parent_tier_name,
-                                      time=annotation[0],
-                                      value=annotation[2])
+    _check_annotations(target_eaf, target_tier_name, annotations, aligned=False)
+    parent_ids = _parent_ids(target_eaf, target_parent_tier_name, [annotation[0] for annotation in annotations])
+    aids = _reserve_annotation_ids(target_eaf, target_tier_name, len(annotations))
+    target_eaf.tiers[target_tier_name][1].update(
+        (aid, (parent_id, annotation[2], None, None))
+        for aid, parent_id, annotation in zip(aids, parent_ids, annotations))
     return target_eaf
 
 
@@ -146,7 +221,7 @@ def _copy_symbolic_subdivision_tier(source_eaf: Type[Eaf] = None,
                                     source_tier_name: str = "",
                                     target_tier_name: str = "",
                                     target_parent_tier_name: str = "",
-                                    override_params: Dict[str, str] = {}):
+                                    override_params: Optional[Dict[str, str]] = None):
     """
     Copy annotations from a SYMBOLIC SUBDIVISION ref tier in one EAF to a new ref tier in another EAF
     Symbolic Subdivisions spread ref annotations evenly across the timespan of the parent annotation.
@@ -161,25 +236,70 @@ def _copy_symbolic_subdivision_tier(source_eaf: Type[Eaf] = None,
     :param override_params: Use this to change tier params from what the tier has in the source file
     :return:
     """
-    params = override_params if override_params else source_eaf.get_parameters_for_tier(source_tier_name)
+    params = override_params or source_eaf.get_parameters_for_tier(source_tier_name)
     target_eaf.add_tier(target_tier_name, ling=params["LINGUISTIC_TYPE_REF"], parent=target_parent_tier_name, tier_dict=params)
     annotations = source_eaf.get_ref_annotation_data_for_tier(source_tier_name)
-    previous_parent_id = None
-    previous_id = None
-    for annotation in annotations:
-        prev = previous_id if annotation[3] == previous_parent_id else None
-        target_eaf.add_ref_annotation(id_tier=target_tier_name,
-                                      tier2=target_parent_tier_name,
-                                      time=annotation[0]+1,
-                                      value=annotation[2],
-                                      prev=prev)
-
-        previous_parent_id = annotation[3] if len(annotation) >= 3 else None
-        previous_id = f"a{target_eaf.maxaid}"
-
+    _check_annotations(target_eaf, target_tier_name, annotations, aligned=False)
+    parent_ids = _parent_ids(target_eaf, target_parent_tier_name, [annotation[0]+1 for annotation in annotations])
+    aids = _reserve_annotation_ids(target_eaf, target_tier_name, len(annotations))
+    # Each annotation refers to the one before it, if they belong to the same parent
+    prev_ids = [None] + [previous_aid if annotation[3] == previous[3] else None
+                         for previous_aid, previous, annotation in zip(aids, annotations, annotations[1:])]
+    target_eaf.tiers[target_tier_name][1].update(
+        (aid, (parent_id, annotation[2], prev, None))
+        for aid, parent_id, annotation, prev in zip(aids, parent_ids, annotations, prev_ids))
     return target_eaf
 
 
+def _children_by_parent(ref_tier: Dict[str, tuple]) -> Dict[str, Tuple[List[str], List[str]]]:
+    """
+    Index the annotations of a ref tier by the id of the annotation they refer to
+
+    :param ref_tier: Reference annotations of the form {id -> (reference, value, previous, svg_ref)}
+    :return: Dict of the form {parent_id -> ([id, ...], [value, ...])}, children in tier order
+    """
+    children = dict()
+    for aid, (ref, value, _, _) in ref_tier.items():
+        if ref not in children:
+            children[ref] = ([], [])
+        ids, values = children[ref]
+        ids.append(aid)
+        values.append(value)
+    return children
+
+
+def _join_glosses(glosses: List[str]) -> str:
+    """
+    Join the glosses of a word's morphs with a dash
+
+    :param glosses: Glosses for each morph of the word, in order
+    :return: The gloss for the word
+    """
+    # Most words only have one morph, so use a single gloss as it is, otherwise join them
+    return glosses[0] if len(glosses) == 1 else '-'.join(glosses)
+
+
+def _word_glosses(utterance_id: str,
+                  word_children: Dict[str, Tuple[List[str], List[str]]],
+                  morph_children: Dict[str, Tuple[List[str], List[str]]],
+                  gloss_children: Dict[str, Tuple[List[str], List[str]]]) -> List[List[str]]:
+    """
+    Walk down from an utterance to its words, their morphs and the morph glosses in one go
+
+    :param utterance_id: Id of the utterance annotation
+    :param word_children: Index of the word tier by parent id, from _children_by_parent
+    :param morph_children: Index of the morph tier by parent id
+    :param gloss_children: Index of the gloss tier by parent id
+    :return: List of [word, gloss] for the utterance, with the glosses of each word joined with a dash
+    """
+    no_children = ((), ())
+    # Ids and values are kept in separate lists, so morphs only need their ids and glosses only their values
+    return [[word_value, _join_glosses([gloss_value
+                                        for morph_id in morph_children.get(word_id, no_children)[0]
+                                        for gloss_value in gloss_children.get(morph_id, no_children)[1]])]
+            for word_id, word_value in zip(*word_children.get(utterance_id, no_children))]
+
+
 def main():
     """
     File 1 has the utterance and utterance translation
@@ -296,59 +416,48 @@ def main():
     gloss_tier = eaf_2_tiers[gloss_source_tier][1]
 
     # Each reference annotation is of the form: [{id -> (reference, value, previous, svg_ref)}].
+    # Index each ref tier by parent id once, so we don't have to scan the whole child tier for every parent
+    word_children = _children_by_parent(word_tier)
+    morph_children = _children_by_parent(morph_tier)
+    gloss_children = _children_by_parent(gloss_tier)
+
     # Start at the top of the hierarchy
     utterance_id_tier = eaf_2_tiers[utterance_id_source_tier][0]
 
-    new_dict = dict()
+    # One flat record per word, of the form (word, gloss), in utterance order
+    word_records: List[Tuple[str, str]] = []
     # For each utterance, get the words. For each word, get the glosses. Merge glosses for each word
     for utterance_id, utterance in utterance_id_tier.items():
         utt_start = eaf_2_timeslots[utterance[0]]
         utt_end = eaf_2_timeslots[utterance[1]]
-        word_gloss: List[Union[int, List[str]]] = []
-        for word_id, word in word_tier.items():
-            if word[0] == utterance_id:
-                glosses = []
-                # Find morphs of this word...
-                for morph_id, morph in morph_tier.items():
-                    # ...by filtering on morph parents id matching the word id
-                    if morph[0] == word_id:
-                        for gloss_id, gloss in gloss_tier.items():
-                            if gloss[0] == morph_id:
-                                glosses.append(gloss[1])
-                # Join glosses for this word with a dash
-                word_gloss.append([word[1], '-'.join(glosses)])
+        word_gloss = _word_glosses(utterance_id, word_children, morph_children, gloss_children)
+        # Utterances without words have nothing to divide the duration between, or to gloss
+        if not word_gloss:
+            continue
         # Now, work out word duration (it is an even division of parent utterance duration)
-        # Make this value the first item in the data list eg [word_duration, [word, gloss], [word, gloss], ...]
         num_segments = len(word_gloss)
         utt_dur = utt_end - utt_start
-        word_dur = int(utt_dur / num_segments)
-        word_gloss = [utt_start, word_dur] + word_gloss
-        print("word gloss", word_gloss)
-        new_dict[utterance_id] = word_gloss
+        word_dur = utt_dur // num_segments
+        print("word gloss", [utt_start, word_dur, *word_gloss])
+        word_records.extend((word, gloss) for word, gloss in word_gloss)
 
     # Having worked all that out, now we can add a ref annotation tier.
     # but parent seems to now bubble all the way to the top.
     eaf_3.add_tier(gloss_target_tier, ling='Blank', parent=word_target_tier, tier_dict=gloss_tier_params)
-    # And some annotations
-    for ann_id, annotation in new_dict.items():
-        utt_start = annotation[0]
-        word_dur = annotation[1]
-        count = 0
-
-        for ann in annotation[2:]:
-            word_start = utt_start + word_dur * count
-            id_tier = gloss_target_tier
-            tier2 = word_target_tier
-            value = ann[1]
-            prev = None
-            svg = None
-
-            for aid, (ref_id, _value, _prev, _) in eaf_3.tiers[tier2][1].items():
-                if ann[0] == _value:
-                    new_aid = eaf_3.generate_annotation_id()
-                    eaf_3.tiers[id_tier][1][new_aid] = (aid, value, prev, svg)
-
-            count = count + 1
+    # Bind the target dicts to locals, they are used for every gloss
+    word_annotations = eaf_3.tiers[word_target_tier][1]
+    gloss_annotations = eaf_3.tiers[gloss_target_tier][1]
+    # Look up word annotations by value. Word strings can repeat, so keep every id that has the value
+    word_value_to_aids = defaultdict(list)
+    for aid, (_, _value, _, _) in word_annotations.items():
+        word_value_to_aids[_value].append(aid)
+    # Every word annotation matching a word value gets a gloss, so we know how many ids we need up front
+    total_glosses = sum(len(word_value_to_aids.get(word, [])) for word, _ in word_records)
+    new_aids = _reserve_annotation_ids(eaf_3, gloss_target_tier, total_glosses)
+    # And some annotations, of the form (reference, value, previous, svg_ref), all added in one update
+    gloss_annotations.update(zip(new_aids, ((aid, gloss, None, None)
+                                            for word, gloss in word_records
+                                            for aid in word_value_to_aids.get(word, []))))
 
     # Save the new file
     print("Saving object to file")